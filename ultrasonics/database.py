@@ -8,9 +8,16 @@ XDGFX, 2020
 """
 
 import ast
+import atexit
+import copy
+import json
 import os
+import queue
 import sqlite3
+import threading
+import time
 import uuid
+from itertools import chain
 
 from ultrasonics import logs
 
@@ -20,6 +27,25 @@ db_file = "config/ultrasonics.db"
 conn = None
 cursor = None
 
+# Setting types which are persisted to the database
+_DB_SETTING_TYPES = frozenset({"text", "radio", "select"})
+
+# Hot-path queries are defined once so every call hands sqlite3 the same
+# string object, guaranteeing statement cache hits instead of re-parsing.
+_Q_SETTINGS_LOAD = "SELECT key, value FROM ultrasonics"
+_Q_SETTINGS_SAVE = "INSERT INTO ultrasonics (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value"
+_Q_SETTINGS_GET = "SELECT value FROM ultrasonics WHERE key = ?"
+_Q_PLUGIN_NEW = "INSERT INTO plugins (plugin, version) VALUES (?,?)"
+_Q_PLUGIN_SET = "UPDATE plugins SET settings = ? WHERE plugin = ? AND version = ?"
+_Q_PLUGIN_EXISTS = "SELECT EXISTS(SELECT 1 FROM plugins WHERE plugin = ?)"
+_Q_PLUGIN_VERSIONS = "SELECT version FROM plugins WHERE plugin = ?"
+_Q_PLUGIN_GET = "SELECT settings FROM plugins WHERE plugin = ? AND version = ?"
+_Q_APPLET_GATHER = "SELECT id, json_extract(data, '$.applet_name'), json_extract(lastrun, '$.time'), json_extract(lastrun, '$.result') FROM applets"
+_Q_APPLET_SET = "REPLACE INTO applets (id, data) VALUES (?,?)"
+_Q_APPLET_GET = "SELECT data FROM applets WHERE id = ?"
+_Q_APPLET_REMOVE = "DELETE FROM applets WHERE id = ?"
+_Q_APPLET_LASTRUN = "UPDATE applets SET lastrun = ? WHERE id = ?"
+
 try:
     os.mkdir("config")
 except FileExistsError:
@@ -27,6 +53,184 @@ except FileExistsError:
     pass
 
 
+def _open(readonly=False):
+    """
+    Open a connection to the database with tuned PRAGMAs applied.
+    WAL mode persists in the database file itself, but the other PRAGMAs
+    are per-connection, so every connection must be opened through here.
+    """
+    conn = sqlite3.connect(db_file, cached_statements=256)
+
+    if db_file != ":memory:":
+        conn.execute("PRAGMA journal_mode=WAL")
+
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA wal_autocheckpoint=400")
+
+    if readonly:
+        conn.execute("PRAGMA query_only=ON")
+
+    return conn
+
+
+# One persistent connection per thread, so the page cache stays warm
+# between calls instead of being rebuilt on every query.
+_local = threading.local()
+
+# Cached results of Core.load, keyed by the raw flag. Cleared whenever the
+# ultrasonics table is written, so every frontend request skips the query.
+_settings_cache = {}
+
+
+def _connect(readonly=False):
+    """
+    Return the persistent connection for the current thread, opening it on
+    first use. Read-only callers get a separate query_only connection, so
+    SQLite skips its write-lock paths entirely and never blocks the writer.
+    """
+    attr = "read_conn" if readonly else "conn"
+    conn = getattr(_local, attr, None)
+
+    if conn is None:
+        conn = _open(readonly)
+        setattr(_local, attr, conn)
+
+    return conn
+
+
+def _dumps(data):
+    """
+    Serialize a dict for storage with compact separators, keeping the
+    stored text as small as possible while staying queryable with json1.
+    """
+    return json.dumps(data, separators=(",", ":"))
+
+
+# Serialize dicts and UUIDs passed as query parameters automatically, so
+# callers don't need to convert them per call.
+sqlite3.register_adapter(dict, _dumps)
+sqlite3.register_adapter(uuid.UUID, str)
+
+
+def _migrate_to_json(cursor):
+    """
+    One-time migration of dict columns written by older versions as Python
+    repr strings, rewriting them as JSON.
+    """
+    for table, column in (("plugins", "settings"),
+                          ("applets", "data"),
+                          ("applets", "lastrun")):
+        query = "SELECT id, {} FROM {} WHERE {} IS NOT NULL".format(
+            column, table, column)
+
+        for row_id, value in cursor.execute(query).fetchall():
+            try:
+                json.loads(value)
+            except ValueError:
+                cursor.execute(
+                    "UPDATE {} SET {} = ? WHERE id = ?".format(table, column),
+                    (_dumps(ast.literal_eval(value)), row_id))
+
+
+@atexit.register
+def _optimize():
+    """
+    Refresh query planner statistics on shutdown, as recommended by SQLite.
+    """
+    try:
+        _connect().execute("PRAGMA optimize")
+    except sqlite3.Error:
+        pass
+
+
+# Pending lastrun updates, coalesced by a background thread so that many
+# applets finishing at once share a single transaction and fsync.
+_lastrun_queue = queue.Queue()
+_lastrun_worker = None
+_lastrun_lock = threading.Lock()
+
+# Maintenance intervals for the writer thread. WAL only grows while
+# writes happen, so tying maintenance to the write loop is sufficient.
+_WAL_CHECKPOINT_INTERVAL = 60
+_OPTIMIZE_INTERVAL = 900
+
+
+def _flush_lastrun(batch):
+    """
+    Write a batch of queued (lastrun, applet_id) updates in one transaction.
+    """
+    try:
+        with _connect() as conn:
+            conn.executemany(_Q_APPLET_LASTRUN, batch)
+            conn.commit()
+            log.info(f"Applet lastrun updated for {len(batch)} applet(s)")
+    except sqlite3.Error:
+        log.error("Failed to write queued applet lastrun updates")
+
+
+def _lastrun_loop():
+    last_checkpoint = last_optimize = time.monotonic()
+
+    while True:
+        # Block for the first update, then drain anything else arriving
+        # within the coalescing window into the same batch
+        batch = [_lastrun_queue.get()]
+
+        try:
+            while True:
+                batch.append(_lastrun_queue.get(timeout=0.1))
+        except queue.Empty:
+            pass
+
+        _flush_lastrun(batch)
+
+        # Periodically truncate the WAL file so readers never scan a large
+        # backlog of frames, and keep the planner statistics fresh
+        now = time.monotonic()
+
+        try:
+            if now - last_checkpoint >= _WAL_CHECKPOINT_INTERVAL:
+                _connect().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                last_checkpoint = now
+
+            if now - last_optimize >= _OPTIMIZE_INTERVAL:
+                _connect().execute("PRAGMA optimize")
+                last_optimize = now
+        except sqlite3.Error:
+            log.error("Database maintenance failed")
+
+
+def _start_lastrun_worker():
+    global _lastrun_worker
+
+    with _lastrun_lock:
+        if _lastrun_worker is None:
+            _lastrun_worker = threading.Thread(
+                target=_lastrun_loop, name="db-lastrun-writer", daemon=True)
+            _lastrun_worker.start()
+
+
+@atexit.register
+def flush_writes():
+    """
+    Synchronously write any lastrun updates still waiting in the queue.
+    Runs at shutdown, before the PRAGMA optimize hook.
+    """
+    batch = []
+
+    try:
+        while True:
+            batch.append(_lastrun_queue.get_nowait())
+    except queue.Empty:
+        pass
+
+    if batch:
+        _flush_lastrun(batch)
+
+
 class Core:
     """
     Core ultrasonics database functions.
@@ -77,28 +281,30 @@ class Core:
         """
         Initial connection to database to create tables.
         """
-        with sqlite3.connect(db_file) as conn:
+        with _connect() as conn:
+            # Deferred to avoid a circular import with app; connect() only
+            # runs once at startup so the lookup cost doesn't matter here
             from app import _ultrasonics
 
             cursor = conn.cursor()
             log.info("Database connection successful")
 
-            if self.new_install() is None:
-                _ultrasonics["new_install"] = True
+            # Run the install check, table creation and default settings in a
+            # single transaction so first boot pays for one commit only.
+            cursor.execute("BEGIN IMMEDIATE")
+
+            table_exists = self.new_install(cursor=cursor) is not None
 
-                # Create tuple with default settings
-                global_settings_database = [(item["name"], item["value"])
-                                            for item in self.settings if item["type"] in ["text", "radio", "select"]]
+            if not table_exists:
+                _ultrasonics["new_install"] = True
 
                 # Create persistent settings table if needed
-                query = "CREATE TABLE IF NOT EXISTS ultrasonics (key TEXT, value TEXT)"
+                query = "CREATE TABLE IF NOT EXISTS ultrasonics (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID"
                 cursor.execute(query)
 
                 query = "INSERT INTO ultrasonics (key, value) VALUES(?, ?)"
-                cursor.executemany(query, list(_ultrasonics.items()))
-
-                query = "INSERT INTO ultrasonics (key, value) VALUES(?, ?)"
-                cursor.executemany(query, global_settings_database)
+                cursor.executemany(query, chain(
+                    _ultrasonics.items(), _GLOBAL_SETTINGS_DEFAULTS))
 
             # Create persistent settings table if needed
             query = "CREATE TABLE IF NOT EXISTS plugins (id INTEGER PRIMARY KEY, plugin TEXT, version FLOAT, settings TEXT)"
@@ -108,82 +314,114 @@ class Core:
             query = "CREATE TABLE IF NOT EXISTS applets (id TEXT PRIMARY KEY, lastrun TEXT, data TEXT)"
             cursor.execute(query)
 
-            conn.commit()
+            # Rebuild settings tables from before key was the primary key,
+            # which also removes any duplicate rows
+            cursor.execute("PRAGMA table_info(ultrasonics)")
+            key_is_pk = any(column[1] == "key" and column[5]
+                            for column in cursor.fetchall())
+
+            if table_exists and not key_is_pk:
+                cursor.execute(
+                    "ALTER TABLE ultrasonics RENAME TO ultrasonics_old")
+                cursor.execute(
+                    "CREATE TABLE ultrasonics (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+                cursor.execute(
+                    "INSERT OR REPLACE INTO ultrasonics SELECT key, value FROM ultrasonics_old")
+                cursor.execute("DROP TABLE ultrasonics_old")
+
+            # Index the plugin lookup columns so plugin queries don't scan;
+            # the ultrasonics primary key already covers settings lookups
+            query = "CREATE INDEX IF NOT EXISTS idx_plugins_plugin_version ON plugins (plugin, version)"
+            cursor.execute(query)
+
+            # Rewrite any repr-serialized rows from older versions as JSON
+            _migrate_to_json(cursor)
 
             # Version check
             query = "SELECT value FROM ultrasonics WHERE key = 'version'"
             cursor.execute(query)
-            rows = cursor.fetchall()
-            version = rows[0][0]
+            version = cursor.fetchone()[0]
+
+            conn.commit()
+            _settings_cache.clear()
 
             if version != _ultrasonics["version"]:
                 log.warning(
                     "Installed ultrasonics version does not match database version! Proceed with caution.")
 
-    def new_install(self, update=False):
+    def new_install(self, update=False, cursor=None):
         """
         Check if this is a new installation of ultrasonics.
+        If a cursor is supplied, it is reused and the caller owns the
+        transaction; otherwise one is taken from the shared connection.
         """
-        with sqlite3.connect(db_file) as conn:
+        conn = None
+
+        if cursor is None:
+            conn = _connect(readonly=not update)
             cursor = conn.cursor()
-            if update:
-                query = "UPDATE ultrasonics SET value = 0 WHERE key = 'new_install'"
-                cursor.execute(query)
-                conn.commit()
-                log.info("Welcome to ultrasonics! 🔊")
-            else:
-                # Check if database exists
-                query = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'ultrasonics'"
-                cursor.execute(query)
-                rows = cursor.fetchall()
 
-                result = rows[0][0]
+        if update:
+            query = "UPDATE ultrasonics SET value = 0 WHERE key = 'new_install'"
+            cursor.execute(query)
 
-                # Table does not exist
-                if not result:
-                    return None
+            if conn is not None:
+                conn.commit()
 
-                query = "SELECT value FROM ultrasonics WHERE key = 'new_install'"
-                cursor.execute(query)
-                rows = cursor.fetchall()
+            _settings_cache.clear()
+            log.info("Welcome to ultrasonics! 🔊")
+        else:
+            # Check if database exists
+            query = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'ultrasonics'"
+            cursor.execute(query)
+            result = cursor.fetchone()[0]
 
-                result = rows[0][0]
+            # Table does not exist
+            if not result:
+                return None
+
+            query = "SELECT value FROM ultrasonics WHERE key = 'new_install'"
+            cursor.execute(query)
+            result = cursor.fetchone()[0]
 
-                return result == '1'
+            return result == '1'
 
     def load(self, raw=False):
         """
         Return all the current global settings in full dict format.
         If raw, return only key: value dict
         """
-        import copy
+        if raw in _settings_cache:
+            return copy.deepcopy(_settings_cache[raw])
 
-        with sqlite3.connect(db_file) as conn:
+        with _connect(readonly=True) as conn:
             cursor = conn.cursor()
-            query = "SELECT key, value FROM ultrasonics"
+            query = _Q_SETTINGS_LOAD
             cursor.execute(query)
-            rows = cursor.fetchall()
 
             if raw:
                 data = {}
 
-                for key, value in rows:
+                for key, value in cursor:
                     data[key] = value
 
             else:
-                data = copy.deepcopy(self.settings)
+                # Shallow dict copies are enough, the values are all primitives
+                data = [dict(item) for item in self.settings]
 
-                db_compatible_settings = [
-                    item["name"] for item in data if item["type"] in ["text", "radio", "select"]]
+                name_to_idx = {item["name"]: i for i, item in enumerate(data)
+                               if item["type"] in _DB_SETTING_TYPES}
 
-                for key, value in rows:
+                for key, value in cursor:
                     # Check if database setting is to be displayed (excluding version, new_install)
-                    if key in db_compatible_settings:
-                        for i, item in enumerate(data):
-                            if "name" in item and item["name"] == key:
-                                # If setting matches database item, update the value
-                                item["value"] = value
-                                data[i] = item
+                    idx = name_to_idx.get(key)
+
+                    if idx is not None:
+                        # If setting matches database item, update the value
+                        data[idx]["value"] = value
+
+            # Cache a private copy so callers cannot mutate it
+            _settings_cache[raw] = copy.deepcopy(data)
             return data
 
     def save(self, settings):
@@ -194,32 +432,37 @@ class Core:
         if settings["api_url"][-1] != "/":
             settings["api_url"] = settings["api_url"] + "/"
 
-        # Generate key, value tuples (reversed for database entry) from supplied form data
-        data = [(value, key)
+        # Generate key, value tuples from supplied form data
+        data = [(key, value)
                 for key, value in settings.items() if key != "action"]
 
-        with sqlite3.connect(db_file) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            query = "UPDATE ultrasonics SET value = ? WHERE key = ?"
+            query = _Q_SETTINGS_SAVE
             cursor.executemany(query, data)
 
             conn.commit()
+            _settings_cache.clear()
             log.info("Settings database updated")
 
     def get(self, key):
         """
         Get a specific value from the ultrasonics core database.
         """
-        with sqlite3.connect(db_file) as conn:
+        with _connect(readonly=True) as conn:
             cursor = conn.cursor()
-            query = "SELECT value FROM ultrasonics WHERE key = ?"
+            query = _Q_SETTINGS_GET
             cursor.execute(query, (key,))
-            rows = cursor.fetchall()
+            row = cursor.fetchone()
 
-            try:
-                return rows[0][0]
-            except IndexError:
-                return None
+            return row[0] if row is not None else None
+
+
+# Default (name, value) pairs written on a new install, derived from the
+# settings list once at import time rather than on every connect() call
+_GLOBAL_SETTINGS_DEFAULTS = tuple((item["name"], item["value"])
+                                  for item in Core.settings
+                                  if item["type"] in _DB_SETTING_TYPES)
 
 
 class Plugin:
@@ -231,10 +474,10 @@ class Plugin:
         """
         Create a database entry for a given plugin.
         """
-        with sqlite3.connect(db_file) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            query = "INSERT INTO plugins (plugin, version) VALUES (?,?)"
-            cursor.execute(query, (str(name), str(version)))
+            query = _Q_PLUGIN_NEW
+            cursor.execute(query, (name, str(version)))
             conn.commit()
             log.info("Plugin database entry created")
 
@@ -242,46 +485,49 @@ class Plugin:
         """
         Update an existing plugin entry in the database.
         """
-        with sqlite3.connect(db_file) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            query = "UPDATE plugins SET settings = ? WHERE plugin = ? AND version = ?"
-            cursor.execute(query, (str(settings), name, version))
+            query = _Q_PLUGIN_SET
+            cursor.execute(query, (_dumps(settings), name, version))
             conn.commit()
             log.info("Plugin database entry updated")
 
+    def exists(self, name):
+        """
+        Check whether any version of a given plugin is configured in the
+        database, without fetching the version rows.
+        """
+        with _connect(readonly=True) as conn:
+            cursor = conn.cursor()
+            query = _Q_PLUGIN_EXISTS
+            cursor.execute(query, (name,))
+
+            return cursor.fetchone()[0] == 1
+
     def versions(self, name):
         """
         Find plugins with a given name, and return the versions of plugins configured for the database.
+        Returns an empty list when the plugin has no entries.
         """
-        with sqlite3.connect(db_file) as conn:
+        with _connect(readonly=True) as conn:
             cursor = conn.cursor()
-            query = "SELECT version FROM plugins WHERE plugin = ?"
-            cursor.execute(query, (name,))
-            rows = cursor.fetchall()
+            query = _Q_PLUGIN_VERSIONS
 
-            if len(rows) > 0:
-                versions = list()
-                for item in rows:
-                    versions.append(str(item[0]))
-                return versions
-            else:
-                return [False]
+            return [str(version)
+                    for (version,) in cursor.execute(query, (name,))]
 
     def get(self, name, version):
         """
         Load the settings from a specific plugin in the database.
         """
-        with sqlite3.connect(db_file) as conn:
+        with _connect(readonly=True) as conn:
             cursor = conn.cursor()
-            query = "SELECT settings FROM plugins WHERE plugin = ? AND version = ?"
+            query = _Q_PLUGIN_GET
             cursor.execute(query, (name, version))
-            rows = cursor.fetchall()
-
-            settings = rows[0][0]
+            settings = cursor.fetchone()[0]
 
             if settings is not None:
-                import ast
-                settings = ast.literal_eval(settings)
+                settings = json.loads(settings)
 
             return settings
 
@@ -293,46 +539,43 @@ class Applet:
 
     def gather(self):
         """
-        Return all the applets stored in the database.
+        Return a summary of all the applets stored in the database.
+        Only the fields needed for listing and scheduling are extracted by
+        SQLite itself, so the full plan tree is never parsed here; use
+        get() to load an applet's complete plans.
         """
-        with sqlite3.connect(db_file) as conn:
+        with _connect(readonly=True) as conn:
             cursor = conn.cursor()
-            query = "SELECT id, lastrun, data FROM applets"
-            cursor.execute(query)
-            rows = cursor.fetchall()
-
-            if rows is None:
-                return []
+            query = _Q_APPLET_GATHER
 
             data = []
 
-            for applet_id, applet_lastrun, applet_plans in rows:
-                if applet_lastrun is None:
-                    data.append(
-                        {
-                            "applet_id": applet_id,
-                            "applet_plans": ast.literal_eval(applet_plans)
-                        }
-                    )
-                else:
-                    data.append(
-                        {
-                            "applet_id": applet_id,
-                            "applet_plans": ast.literal_eval(applet_plans),
-                            "applet_lastrun": ast.literal_eval(applet_lastrun)
-                        }
-                    )
+            for applet_id, applet_name, lastrun_time, lastrun_result in cursor.execute(query):
+                applet = {
+                    "applet_id": applet_id,
+                    "applet_plans": {
+                        "applet_name": applet_name
+                    }
+                }
+
+                if lastrun_time is not None or lastrun_result is not None:
+                    applet["applet_lastrun"] = {
+                        "time": lastrun_time,
+                        "result": bool(lastrun_result)
+                    }
+
+                data.append(applet)
+
             return data
 
     def set(self, applet_id, data):
         """
         Create or update a new applet.
         """
-        with sqlite3.connect(db_file) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            query = "REPLACE INTO applets (id, data) VALUES (?,?)"
-            cursor.execute(
-                query, (str(applet_id), str(data)))
+            query = _Q_APPLET_SET
+            cursor.execute(query, (applet_id, _dumps(data)))
             conn.commit()
             log.info("Applet database entry created")
 
@@ -340,26 +583,26 @@ class Applet:
         """
         Load an applet plans from it's unique id.
         """
-        with sqlite3.connect(db_file) as conn:
+        with _connect(readonly=True) as conn:
             cursor = conn.cursor()
-            query = "SELECT data FROM applets WHERE id = ?"
+            query = _Q_APPLET_GET
             cursor.execute(query, (applet_id, ))
-            rows = cursor.fetchall()
+            row = cursor.fetchone()
 
-            if rows == []:
+            if row is None:
                 return None
             else:
                 # Convert from string to dict
-                applet_plans = ast.literal_eval(rows[0][0])
+                applet_plans = json.loads(row[0])
                 return applet_plans
 
     def remove(self, applet_id):
         """
         Delete an applet from the database.
         """
-        with sqlite3.connect(db_file) as conn:
+        with _connect() as conn:
             cursor = conn.cursor()
-            query = "DELETE FROM applets WHERE id = ?"
+            query = _Q_APPLET_REMOVE
             cursor.execute(query, (applet_id,))
             conn.commit()
             log.info("Applet database entry deleted")
@@ -367,11 +610,8 @@ class Applet:
     def lastrun(self, applet_id, data):
         """
         Update the lastrun column for an applet with the supplied data.
+        Updates are queued and flushed in batches by a background thread,
+        so applets finishing together share one commit.
         """
-        with sqlite3.connect(db_file) as conn:
-            cursor = conn.cursor()
-            query = "UPDATE applets SET lastrun = ? WHERE id = ?"
-            cursor.execute(
-                query, (str(data), str(applet_id)))
-            conn.commit()
-            log.info("Applet lastrun updated")
+        _start_lastrun_worker()
+        _lastrun_queue.put((_dumps(data), applet_id))
@@ -96,7 +96,7 @@ def plugin_gather():
                     dbp.new(title, handshake_version)
 
                     # If an older minor version exists, migrate settings.
-                    if existing_versions != [False]:
+                    if existing_versions:
                         from ultrasonics.tools import version_check
                         migration_version = version_check.check(
                             handshake_version, existing_versions)